@@ -0,0 +1,66 @@
+
+# Measures peak RSS when writing and reading one very large value, first with
+# put_stream()/get_stream() and then with plain put()/get().
+#
+# ru_maxrss only ever goes up, so the streaming numbers are taken first.
+# Usage: python bench_large_values.py [size_in_mb]  (default is 1024, i.e. 1 GB)
+
+import os
+import resource
+import shutil
+import sys
+import time
+
+from bitcask import BitCask
+
+ONE_MB_IN_BYTES = int(2 ** 20)
+
+
+def peak_rss_mb() -> float:
+    # linux reports ru_maxrss in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_source_file(file_path: str, size_in_mb: int) -> None:
+    chunk = os.urandom(ONE_MB_IN_BYTES)
+    with open(file_path, 'wb') as f:
+        for _ in range(size_in_mb):
+            f.write(chunk)
+
+
+if __name__ == "__main__":
+
+    size_in_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    dir_path = "bench_large_values_data"
+    source_path = "bench_large_values_source"
+
+    shutil.rmtree(dir_path, ignore_errors=True)
+    write_source_file(source_path, size_in_mb)
+    bc = BitCask(directory_path=dir_path)
+    print(f"value size: {size_in_mb} MB, baseline peak RSS: {peak_rss_mb():.1f} MB")
+
+    start = time.time()
+    with open(source_path, 'rb') as f:
+        bc.put_stream(b'big', f)
+    print(f"put_stream: {time.time() - start:.2f}s, peak RSS: {peak_rss_mb():.1f} MB")
+
+    start = time.time()
+    total = 0
+    for chunk in bc.get_stream(b'big'):
+        total += len(chunk)
+    assert total == size_in_mb * ONE_MB_IN_BYTES
+    print(f"get_stream: {time.time() - start:.2f}s, peak RSS: {peak_rss_mb():.1f} MB")
+
+    start = time.time()
+    with open(source_path, 'rb') as f:
+        bc.put(b'big_whole', f.read())
+    print(f"put:        {time.time() - start:.2f}s, peak RSS: {peak_rss_mb():.1f} MB")
+
+    start = time.time()
+    value = bc.get(b'big_whole')
+    assert len(value) == size_in_mb * ONE_MB_IN_BYTES
+    del value
+    print(f"get:        {time.time() - start:.2f}s, peak RSS: {peak_rss_mb():.1f} MB")
+
+    shutil.rmtree(dir_path, ignore_errors=True)
+    os.remove(source_path)
@@ -0,0 +1,51 @@
+
+# Times snapshot() against the size of the BitCask directory, with a plain
+# shutil.copytree() of the same directory for comparison.
+#
+# Usage: python bench_snapshot.py [size_in_mb ...]  (default is 16 64 256 1024)
+
+import os
+import shutil
+import sys
+import time
+
+from bitcask import BitCask
+
+ONE_MB_IN_BYTES = int(2 ** 20)
+
+
+def directory_size_mb(dir_path: str) -> float:
+    return sum(os.path.getsize(dir_path + '/' + f) for f in os.listdir(dir_path)) / ONE_MB_IN_BYTES
+
+
+if __name__ == "__main__":
+
+    sizes_in_mb = [int(arg) for arg in sys.argv[1:]] or [16, 64, 256, 1024]
+    dir_path = "bench_snapshot_data"
+    snapshot_path = "bench_snapshot_snap"
+    copy_path = "bench_snapshot_copy"
+    value = os.urandom(64 * 1024)
+
+    print(f"{'dir size (MB)':>14} {'segments':>9} {'snapshot (s)':>13} {'copytree (s)':>13}")
+    for size_in_mb in sizes_in_mb:
+
+        for path in [dir_path, snapshot_path, copy_path]:
+            shutil.rmtree(path, ignore_errors=True)
+
+        bc = BitCask(directory_path=dir_path)
+        for i in range(size_in_mb * 16):
+            bc.put(str(i % 1000).encode(), value)
+
+        start = time.time()
+        bc.snapshot(snapshot_path)
+        snapshot_seconds = time.time() - start
+
+        start = time.time()
+        shutil.copytree(dir_path, copy_path)
+        copy_seconds = time.time() - start
+
+        print(f"{directory_size_mb(dir_path):>14.0f} {len(bc.inactive_segments) + 1:>9} "
+              f"{snapshot_seconds:>13.4f} {copy_seconds:>13.4f}")
+
+    for path in [dir_path, snapshot_path, copy_path]:
+        shutil.rmtree(path, ignore_errors=True)
@@ -1,9 +1,13 @@
 
 from datetime import datetime
+import fcntl
+import json
 import os
 import re
-from typing import Optional
-import math
+import shutil
+import tempfile
+import threading
+from typing import BinaryIO, Iterator, Optional
 import sys
 
 
@@ -12,8 +16,13 @@ import sys
 # Byte string of 1 length requires 1 bytes.
 # Byte string of 256 length requires 2 bytes.
 # Byte string of 65536 length requires 3 bytes.
-# Keys will be a fixed size of 2 bytes, values will be a fixed size of 3 bytes
-# timestamps will be 26 bytes 
+# Key and value sizes are stored as unsigned LEB128 varints (7 bits per byte,
+# high bit set means "more bytes follow"), so there is no upper limit on
+# either of them. A size below 128 only costs a single byte.
+# timestamps will be 26 bytes (microseconds are always written, even when zero)
+# The value size varint is actually stored as value_size + 1. A stored 0 is
+# reserved for tombstones (deletes), which have no value bytes at all, so any
+# value (including an empty one) can still be stored.
 
 
 class BitCask():
@@ -27,9 +36,10 @@ class BitCask():
                         object. this is where all segment data files will be
                         stored and written to (before and after compaction).
     - write:    boolean to represent whether this instance of the object has
-                the ability to write. Default is to create objects that can 
-                only read. "We're all adults here" - so don't create multiple
-                objects with write access in the same directory. 
+                the ability to write. Only one writer may have a directory
+                open at a time, this is enforced with an exclusive lock on
+                the LOCK file in the directory (released by close()).
+                Any number of read-only instances can be opened alongside it.
     """
     
     def __init__(self, directory_path: Optional[str] = None, write: bool = True,
@@ -48,8 +58,17 @@ class BitCask():
         self._FILE_SEG_ID_DIGITS = 7
         self._FILE_SEG_PATTERN = '^' + self._FILE_SEG_ID_PREFIX + '[0-9]{' + str(self._FILE_SEG_ID_DIGITS) + '}$'
         self._FILE_SEG_BYTE_THRESHOLD = 2 ** 20
-        self._KEYSIZE_BYTES = 2
-        self._VALUESIZE_BYTES = 3
+        self._STREAM_CHUNK_BYTES = 2 ** 16
+        self._TIMESTAMP_BYTES = 26
+        self._MANIFEST_FILENAME = "MANIFEST"
+        self._LOCK_FILENAME = "LOCK"
+        self._lock_file = None
+        self.manifest_generation = 0
+        self.hint_files = []
+
+        # held while appending a record (and rotating segments) so that a
+        # snapshot always sees a consistent segment list and active offset
+        self._write_lock = threading.Lock()
 
         # determine the data directory path for this instance of bitcask
         if not directory_path:
@@ -60,19 +79,76 @@ class BitCask():
         except FileExistsError:
             print("Directory already exists, will search for segment files in existing data directory...")
 
-        # identify and set the current file
-        existing_data_files = [f for f in os.listdir(self.directory_path) if re.search(self._FILE_SEG_PATTERN, f)]
-        if existing_data_files:
-            self.current_file = max(existing_data_files)
+        # only one writer per directory. flock is released automatically if
+        # the process dies, so a crashed writer never leaves a stale lock.
+        if self.writable:
+            self._lock_file = open(self.directory_path + '/' + self._LOCK_FILENAME, 'ab')
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._lock_file.close()
+                self._lock_file = None
+                raise Exception(f"Another writer already has {self.directory_path} open.")
+
+        # identify and set the current file. The manifest has the segments in
+        # the order they were written, which keeps working after the segment
+        # ids wrap back around to zero and doesn't require listing the directory.
+        if os.path.exists(self._manifest_fullpath):
+            with open(self._manifest_fullpath, 'r') as f:
+                manifest = json.load(f)
+            self.current_file = manifest['active_segment']
+            self.inactive_segments = [self.directory_path + '/' + seg for seg in manifest['segments']
+                                      if seg != self.current_file]
+            self.manifest_generation = manifest['generation']
+            self.hint_files = manifest['hint_files']
         else:
-            self.current_file = self._filename_format(0)
-            print("No segment files existed, starting from segment file zero...")
-            with open(self.current_file_fullpath, 'wb') as f:
-                f.write(b'')
+            # directories from before the manifest existed: scan once and go by
+            # filename order, the manifest written below takes over from here
+            existing_data_files = sorted(f for f in os.listdir(self.directory_path) if re.search(self._FILE_SEG_PATTERN, f))
+            if existing_data_files:
+                self.current_file = existing_data_files[-1]
+                self.inactive_segments = [self.directory_path + '/' + seg for seg in existing_data_files[:-1]]
+            else:
+                self.current_file = self._filename_format(0)
+                print("No segment files existed, starting from segment file zero...")
+                with open(self.current_file_fullpath, 'wb') as f:
+                    f.write(b'')
 
         # initialize the keydir (in-memory hashed key structure)
         self.key_table_size = hash_table_size
         self.keydir = [-1] * self.key_table_size
+        for segment_fullpath in self.inactive_segments + [self.current_file_fullpath]:
+            records_end = self._build_keydir_from_segment(segment_fullpath)
+
+        # a crash mid-write can leave a torn record at the end of the active
+        # segment. Appending after it would make the next reopen read the new
+        # record as the torn one's value, so cut it off before writing anything.
+        if self.writable and os.stat(self.current_file_fullpath).st_size > records_end:
+            print(f"Truncating a partially written record at the end of {self.current_file}...")
+            os.truncate(self.current_file_fullpath, records_end)
+
+        # every writable open bumps the generation, which also gives legacy
+        # directories their first manifest
+        if self.writable:
+            self._update_manifest()
+
+
+    def close(self) -> None:
+        """
+        Release the writer lock so another writable BitCask can open this
+        directory. The instance shouldn't be written to after this.
+        """
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+        self.writable = False
+
+
+    def __del__(self):
+        # _lock_file won't exist if __init__ failed before setting it
+        if getattr(self, '_lock_file', None) is not None:
+            self.close()
 
 
     @property
@@ -83,6 +159,11 @@ class BitCask():
         return self.directory_path + '/' + self.current_file
 
 
+    @property
+    def _manifest_fullpath(self):
+        return self.directory_path + '/' + self._MANIFEST_FILENAME
+
+
     @property
     def current_file_number(self) -> int:
         """
@@ -92,13 +173,13 @@ class BitCask():
         return int(re.search("[0-9]{" + str(self._FILE_SEG_ID_DIGITS) + "}$", self.current_file).group(0))
 
 
-    def put(self, key: bytes, value: bytes) -> None:
+    def put(self, key: bytes, value: bytes) -> tuple:
         """
         Writing data consist of the following steps that BOTH INVOLVE SIDE EFFECTS:
         1. write the data to disk according to the current, active file segment:
             - timestamp  (fixed 26 bytes)
-            - key_size   (fixed 2 bytes)
-            - value_size (fixed 3 bytes)
+            - key_size   (varint, 1+ bytes)
+            - value_size (varint, 1+ bytes, stored as value_size + 1)
             - key        (variable size)
             - value      (variable size)
         2. write or update the in-memory keydir list of dictionaries
@@ -106,45 +187,39 @@ class BitCask():
             - value_sz
             - value_pos
             - tstamp
+
+        Returns (segment file, record start, record end) of the record written.
         """
+        return self._append_record(key, len(value), [value])
 
-        if not self.writable:
-            raise Exception("This instance of BitCask is not writable")
 
-        # make sure key and value are within the size limits for our data structure
-        if self._get_num_bytes_of_int(len(key)) > self._KEYSIZE_BYTES:
-            raise Exception("Key is too large to be stored in this structure.")
-        
-        if self._get_num_bytes_of_int(len(value)) > self._VALUESIZE_BYTES:
-            raise Exception("Value is too large to be stored in this structure.")
-
-        _ts = str(datetime.utcnow())
-
-        # append bytes to our current log segment file
-        with open(self.directory_path + '/' + self.current_file, "ab") as f:
-            # write fixed size elements
-            f.write(_ts.encode('utf-8'))
-            f.write(len(key).to_bytes(length=self._KEYSIZE_BYTES, byteorder=sys.byteorder))
-            f.write(len(value).to_bytes(length=self._VALUESIZE_BYTES, byteorder=sys.byteorder))
-            # write variable sized elements
-            f.write(key)
-            value_position = f.tell()  # capture starting position of value
-            f.write(value)
-        
-        # update in-memory keydir
-        key_dict = {
-            'file_id': self.current_file_fullpath,
-            'value_size': len(value),
-            'value_position': value_position,
-            'timestampe': _ts
-        }
-        hashmod_int_key = self._hashmod_this_key(key)
-        self.keydir[hashmod_int_key] = key_dict
+    def put_stream(self, key: bytes, file_like: BinaryIO, value_size: Optional[int] = None) -> tuple:
+        """
+        Same as put(), but the value is read from a binary file-like object in
+        chunks of _STREAM_CHUNK_BYTES so that it never has to sit in memory all
+        at once.
+
+        The value size has to be written in the record header before the value
+        itself, so we need to know it up front:
+        - if value_size is given, exactly that many bytes are read from file_like
+        - if file_like is seekable, the size is whatever is left after its
+          current position
+        - otherwise the stream is spooled to a temporary file first (on disk,
+          not in memory) to find out how big it is
+        """
 
-        # TODO: check file size (value_position will work)
-        if value_position > self._FILE_SEG_BYTE_THRESHOLD:
-            self._change_active_file()
-        return
+        if value_size is None and not self._is_seekable(file_like):
+            with tempfile.TemporaryFile() as spool:
+                shutil.copyfileobj(file_like, spool, self._STREAM_CHUNK_BYTES)
+                spool.seek(0)
+                return self.put_stream(key, spool)
+
+        if value_size is None:
+            start = file_like.tell()
+            value_size = file_like.seek(0, os.SEEK_END) - start
+            file_like.seek(start)
+
+        return self._append_record(key, value_size, self._read_chunks(file_like, value_size))
 
 
     def get(self, key: bytes) -> bytes:
@@ -159,7 +234,7 @@ class BitCask():
         # }
 
 
-        key_dir_record = self.keydir[self._hashmod_this_key(key)]
+        key_dir_record = self._get_keydir_record(key)
         with open(key_dir_record['file_id'], 'rb') as f:
 
             f.seek(key_dir_record['value_position'])
@@ -168,25 +243,327 @@ class BitCask():
         return value
 
 
+    def get_many(self, keys) -> dict:
+        """
+        Batched get(). Returns a dict of key -> value for every key that
+        exists (missing or deleted keys are left out). The reads are grouped by
+        segment file and sorted by position, so each segment is opened once
+        and read front to back instead of seeking all over the place.
+        """
+        records_by_file = {}
+        for key in keys:
+            key_dir_record = self.keydir[self._hashmod_this_key(key)]
+            if key_dir_record == -1:
+                continue
+            records_by_file.setdefault(key_dir_record['file_id'], []).append(
+                (key_dir_record['value_position'], key_dir_record['value_size'], key))
+
+        values = {}
+        for file_id, records in records_by_file.items():
+            with open(file_id, 'rb') as f:
+                for value_position, value_size, key in sorted(records):
+                    f.seek(value_position)
+                    values[key] = f.read(value_size)
+        return values
+
+
+    def delete(self, key: bytes) -> tuple:
+        """
+        Append a tombstone record for key and drop it from the keydir. The old
+        value stays on disk until a merge (which doesn't exist yet).
+        Returns the record location, same as put().
+        """
+        return self._append_record(key, None, [])
+
+
+    def get_stream(self, key: bytes) -> Iterator[bytes]:
+        """
+        Query the log-structure hash index by key, but yield the value back in
+        chunks of (at most) _STREAM_CHUNK_BYTES instead of one big bytes object.
+        The segment file stays open until the generator is exhausted or closed.
+
+        Not a generator itself, so a missing key raises KeyError right away
+        like get() does, instead of on the first next().
+        """
+        key_dir_record = self._get_keydir_record(key)
+        return self._stream_value(key_dir_record)
+
+
+    def _stream_value(self, key_dir_record: dict) -> Iterator[bytes]:
+        with open(key_dir_record['file_id'], 'rb') as f:
+
+            f.seek(key_dir_record['value_position'])
+            yield from self._read_chunks(f, key_dir_record['value_size'])
+
+
+    def _get_keydir_record(self, key: bytes) -> dict:
+        key_dir_record = self.keydir[self._hashmod_this_key(key)]
+        if key_dir_record == -1:
+            raise KeyError(key)
+        return key_dir_record
+
+
+    def _append_record(self, key: bytes, value_size: Optional[int], value_chunks) -> tuple:
+        """
+        Shared by put(), put_stream() and delete(). Writes the record header
+        and key, then every chunk in value_chunks (which must add up to
+        value_size bytes), then updates the keydir and rotates segments if
+        needed. A value_size of None writes a tombstone.
+
+        Returns (segment file, record start, record end) so callers (like the
+        secondary indexes) know exactly where the record landed.
+        """
+
+        if not self.writable:
+            raise Exception("This instance of BitCask is not writable")
+
+        # the lock covers the append, the keydir update and any rotation, so
+        # snapshot() can never see a half-rotated segment list
+        with self._write_lock:
+            _ts = datetime.utcnow().isoformat(sep=' ', timespec='microseconds')
+            # timestamp, varint sizes and the key
+            header = (_ts.encode('utf-8') + self._encode_varint(len(key))
+                      + self._encode_varint(0 if value_size is None else value_size + 1) + key)
+
+            # if this record is going to trigger a rotation, make sure the
+            # rotation can happen before anything gets written
+            value_position = os.stat(self.current_file_fullpath).st_size + len(header)
+            if value_position > self._FILE_SEG_BYTE_THRESHOLD:
+                self._check_next_filename()
+
+            # append bytes to our current log segment file
+            with open(self.directory_path + '/' + self.current_file, "ab") as f:
+                record_position = f.tell()
+                # a stream that comes up short (or raises part way through)
+                # would leave a header that lies about the value size, so chop
+                # the partial record back off before passing the error along
+                try:
+                    f.write(header)
+                    bytes_written = 0
+                    for chunk in value_chunks:
+                        bytes_written += f.write(chunk)
+
+                    if bytes_written != (value_size or 0):
+                        raise Exception(f"Expected {value_size} value bytes but only received {bytes_written}.")
+                except BaseException:
+                    f.truncate(record_position)
+                    raise
+
+            # update in-memory keydir
+            segment_fullpath = self.current_file_fullpath
+            key_dict = {
+                'file_id': segment_fullpath,
+                'value_size': value_size,
+                'value_position': value_position,
+                'timestampe': _ts
+            }
+            hashmod_int_key = self._hashmod_this_key(key)
+            self.keydir[hashmod_int_key] = -1 if value_size is None else key_dict
+
+            # TODO: check file size (value_position will work)
+            if value_position > self._FILE_SEG_BYTE_THRESHOLD:
+                self._change_active_file()
+        return segment_fullpath, record_position, value_position + bytes_written
+
+
+    def _read_chunks(self, filehandle, num_bytes: int) -> Iterator[bytes]:
+        """
+        Read num_bytes from the current position of filehandle, yielding
+        chunks of at most _STREAM_CHUNK_BYTES. Stops early at EOF.
+        """
+        remaining = num_bytes
+        while remaining > 0:
+            chunk = filehandle.read(min(remaining, self._STREAM_CHUNK_BYTES))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+
+    def snapshot(self, target_dir: str) -> None:
+        """
+        Take a point-in-time copy of this BitCask into target_dir without
+        stopping writes. BitCask(target_dir) will open the snapshot.
+
+        1. under the write lock, freeze the segment list and the size of the
+           active segment (this is the only part that blocks put())
+        2. hard-link the inactive segments, they are never written to again
+           (falls back to a copy if target_dir is on another filesystem)
+        3. copy the active segment, but only up to the frozen offset. Anything
+           appended after the freeze is not part of the snapshot.
+        4. write a manifest with the segment order so the snapshot doesn't
+           have to guess it from the filenames
+
+        Only the writer can take a snapshot. A read-only instance has a stale
+        segment list and doesn't share the writer's lock, so it could cut the
+        active segment in the middle of a record.
+        """
+
+        if not self.writable:
+            raise Exception("Snapshots can only be taken from the writable instance of BitCask")
+
+        with self._write_lock:
+            inactive_segments = list(self.inactive_segments)
+            active_segment = self.current_file_fullpath
+            active_segment_size = os.stat(active_segment).st_size
+            hint_files = list(self.hint_files)
+            generation = self.manifest_generation
+
+        os.makedirs(target_dir)
+
+        for segment_fullpath in inactive_segments + [self.directory_path + '/' + hint for hint in hint_files]:
+            target_fullpath = target_dir + '/' + os.path.basename(segment_fullpath)
+            try:
+                os.link(segment_fullpath, target_fullpath)
+            except OSError:
+                shutil.copyfile(segment_fullpath, target_fullpath)
+
+        with open(active_segment, 'rb') as src, open(target_dir + '/' + os.path.basename(active_segment), 'wb') as dst:
+            for chunk in self._read_chunks(src, active_segment_size):
+                dst.write(chunk)
+
+        self._write_manifest(target_dir, inactive_segments + [active_segment], generation, hint_files)
+        return
+
+
+    def _update_manifest(self) -> None:
+        """
+        Bump the generation and rewrite this directory's manifest to match the
+        in-memory segment list.
+        """
+        self.manifest_generation += 1
+        self._write_manifest(self.directory_path, self.inactive_segments + [self.current_file_fullpath],
+                             self.manifest_generation, self.hint_files)
+
+
+    def _write_manifest(self, directory_path: str, segments: list, generation: int,
+                        hint_files: list) -> None:
+        """
+        Atomically write the manifest for directory_path. segments are full
+        paths, oldest first, and the last one is the active segment.
+
+        The manifest is written to a temp file, fsync'd and renamed over the
+        old one, so a crash leaves either the old or the new manifest, never
+        half of one.
+        """
+        manifest = {
+            'generation': generation,
+            'segments': [os.path.basename(seg) for seg in segments],
+            'active_segment': os.path.basename(segments[-1]),
+            'hint_files': hint_files,
+        }
+        manifest_fullpath = directory_path + '/' + self._MANIFEST_FILENAME
+        with open(manifest_fullpath + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest_fullpath + '.tmp', manifest_fullpath)
+
+        # make the rename itself durable
+        dir_fd = os.open(directory_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+    def _build_keydir_from_segment(self, segment_fullpath: str) -> int:
+        """
+        Read through one segment file record by record and point the keydir at
+        the values in it. Only the headers and keys are read, values are
+        seeked over. Segments have to be fed in oldest to newest so that the
+        latest write for a key wins.
+
+        Returns the position just after the last complete record.
+        """
+        records_end = 0
+        with open(segment_fullpath, 'rb') as f:
+            for _ts, key, value_position, value_size in self._iter_segment_records(f):
+                records_end = value_position + (value_size or 0)
+
+                if value_size is None:
+                    self.keydir[self._hashmod_this_key(key)] = -1
+                    continue
+
+                self.keydir[self._hashmod_this_key(key)] = {
+                    'file_id': segment_fullpath,
+                    'value_size': value_size,
+                    'value_position': value_position,
+                    'timestampe': _ts.decode('utf-8')
+                }
+        return records_end
+
+
+    def _iter_segment_records(self, filehandle, start_position: int = 0,
+                              end_position: Optional[int] = None) -> Iterator[tuple]:
+        """
+        Walk an open segment file from start_position (which has to be the
+        start of a record) up to end_position (default end of file), yielding
+        (timestamp, key, value_position, value_size) for every complete record,
+        with value_size None for tombstones.
+        The caller is free to seek around and read the value in between, the
+        next header is always found from value_position + value_size.
+        A partially written record at the end of the file is ignored.
+        """
+        file_size = os.fstat(filehandle.fileno()).st_size
+        if end_position is not None:
+            file_size = min(file_size, end_position)
+        next_record_position = start_position
+        while True:
+            filehandle.seek(next_record_position)
+            if next_record_position + self._TIMESTAMP_BYTES > file_size:
+                return
+            _ts = filehandle.read(self._TIMESTAMP_BYTES)
+            try:
+                key_size = self._read_varint(filehandle)
+                stored_value_size = self._read_varint(filehandle)
+            except Exception:
+                return
+            value_size = stored_value_size - 1 if stored_value_size else None
+            key = filehandle.read(key_size)
+            value_position = filehandle.tell()
+            next_record_position = value_position + (value_size or 0)
+            if len(key) < key_size or next_record_position > file_size:
+                return
+
+            yield _ts, key, value_position, value_size
+
+
     def _change_active_file(self):
         """
         Calling this method will deactivate the current file and create a new
         current/active file. These are executed as side effects.
         """
         
+        # work out (and check) the next file before touching any state
+        next_file = self._check_next_filename()
+
         # append current full file path to inactive segments
         self.inactive_segments.append(self.current_file_fullpath)
-
-        # set the new current file, if we're maxed out, return back to zero
-        if self.current_file_number == int("9" * self._FILE_SEG_ID_DIGITS):
-            self.current_file = self._filename_format(0)
-        else:
-            self.current_file = self._filename_format(self.current_file_number + 1)
+        self.current_file = next_file
         
         # get the file started
         with open(self.current_file_fullpath, 'ab') as f:
             f.write(b'')
 
+        self._update_manifest()
+
+
+    def _check_next_filename(self) -> str:
+        """
+        The filename the next rotation will switch to. If we're maxed out it
+        returns back to zero, and raises if that wrapped around onto a segment
+        that is still in use (appending to it would mix new and old data).
+        """
+        if self.current_file_number == int("9" * self._FILE_SEG_ID_DIGITS):
+            next_file = self._filename_format(0)
+        else:
+            next_file = self._filename_format(self.current_file_number + 1)
+
+        if self.directory_path + '/' + next_file in self.inactive_segments:
+            raise Exception(f"Segment id wrapped around onto {next_file}, which is still in use.")
+        return next_file
+
 
     def _filename_format(self, segment_number: int) -> str:
         """
@@ -196,15 +573,44 @@ class BitCask():
         return (self._FILE_SEG_ID_PREFIX + ("{:0" + str(self._FILE_SEG_ID_DIGITS) + "d}").format(segment_number))
 
 
-    def _get_num_bytes_of_int(self, this_int: int) -> int:
+    def _encode_varint(self, this_int: int) -> bytes:
         """
-        Given an integer, tell me the minimum number of
-        bytes required to represent this integer.
-
-        This will commonly be used as such:
-            _get_num_bytes_of_int(len(some_bytes))
+        Encode a non-negative integer as an unsigned LEB128 varint.
+        Example: 300 -> b'\\xac\\x02'
         """
-        return math.ceil(this_int.bit_length() / 8)
+        result = bytearray()
+        while True:
+            low_seven_bits = this_int & 0x7F
+            this_int >>= 7
+            if this_int:
+                result.append(low_seven_bits | 0x80)
+            else:
+                result.append(low_seven_bits)
+                return bytes(result)
+
+
+    def _read_varint(self, filehandle) -> int:
+        """
+        Read an unsigned LEB128 varint starting at the current position of
+        filehandle, leaving the cursor on the first byte after it.
+        """
+        result = 0
+        shift = 0
+        while True:
+            c = filehandle.read(1)
+            if c == b'':
+                raise Exception("Reached end of file in the middle of a varint.")
+            result |= (c[0] & 0x7F) << shift
+            if not c[0] & 0x80:
+                return result
+            shift += 7
+
+
+    def _is_seekable(self, file_like) -> bool:
+        try:
+            return file_like.seekable()
+        except AttributeError:
+            return False
 
 
     def _hashmod_this_key(self, key_bytes: bytes) -> int:
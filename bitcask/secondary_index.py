@@ -0,0 +1,378 @@
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+from typing import Callable, Dict, Optional, Set
+
+from bitcask import BitCask
+
+
+# For Reference:
+# Each secondary index keeps its own append-only log next to the segment files,
+# named "index_<name>.log". Every record in it starts with a one byte type:
+# b'+' is an index entry:
+#   - key_size   (varint)
+#   - value_size (varint, stored as size + 1, a 0 means "key removed from index")
+#   - key        (variable size, the primary key)
+#   - value      (variable size, the indexed value the extractor returned)
+# b'@' is a checkpoint, "the index covers every BitCask record before here":
+#   - generation (varint, the BitCask manifest generation)
+#   - name_size  (varint)
+#   - segment    (variable size, segment file name)
+#   - offset     (varint, a record boundary within that segment)
+# Replaying the log front to back gives the current primary key -> indexed
+# value mapping, which gets inverted into indexed value -> set of primary keys,
+# plus the last checkpoint, from which the index catches up on the segments.
+
+
+class SecondaryIndex():
+    """
+    A single inverted index over the values stored in a BitCask.
+
+    Args:
+    - bitcask:      the BitCask whose values are being indexed
+    - name:         name of the index, also used in the log file name, so only
+                    letters, digits and underscores are allowed
+    - extractor:    function that takes a value (bytes) and returns the bytes
+                    to index it by, or None if this value shouldn't be indexed
+    - max_value_bytes:  values bigger than this are never handed to the
+                    extractor and never indexed, on put or on rebuild. This
+                    keeps a rebuild from loading huge put_stream() values into
+                    memory (up to max_workers of them at once). Default 16 MB.
+    """
+
+    def __init__(self, bitcask: BitCask, name: str, extractor: Callable[[bytes], Optional[bytes]],
+                 max_value_bytes: int = 2 ** 24):
+
+        if not re.search('^[A-Za-z0-9_]+$', name):
+            raise Exception("Index names may only contain letters, digits and underscores.")
+
+        self.bitcask = bitcask
+        self.name = name
+        self.extractor = extractor
+        self.max_value_bytes = max_value_bytes
+        self.log_fullpath = bitcask.directory_path + '/index_' + name + '.log'
+
+        # primary key -> indexed value, needed to know what to remove on an update
+        self.forward = {}
+        # indexed value -> set of primary keys
+        self.inverted = {}
+        # (generation, segment name, offset), see the log format above
+        self.checkpoint = None
+
+
+    def lookup(self, indexed_value: bytes) -> Set[bytes]:
+        """
+        All the primary keys currently indexed under indexed_value.
+        """
+        return set(self.inverted.get(indexed_value, ()))
+
+
+    def extract(self, value: bytes) -> Optional[bytes]:
+        """
+        The indexed value for value, or None if it isn't indexed.
+        """
+        if len(value) > self.max_value_bytes:
+            return None
+        return self.extractor(value)
+
+
+    def update(self, key: bytes, indexed_value: Optional[bytes], location: tuple) -> None:
+        """
+        Call after key was written, with what extract() returned for its value
+        (or None after key was deleted) and the record location the BitCask
+        returned. Logs the entry if the indexed value changed, and moves the
+        checkpoint past the record if it directly follows the old checkpoint.
+        If it doesn't, something was written around this index, and the
+        checkpoint stays put so the next open catches up on it.
+
+        The checkpoint is only logged when it moves to a new segment. Within
+        the active segment it just advances in memory, and the next open
+        rescans (at most) that one segment from the last logged checkpoint,
+        instead of the log growing by a checkpoint on every write.
+        """
+        log_bytes = b''
+        if self.forward.get(key) != indexed_value:
+            self._apply(key, indexed_value)
+            log_bytes += self._encode_log_entry(key, indexed_value)
+
+        segment_fullpath, record_start, record_end = location
+        if self.checkpoint is not None and self.checkpoint[1:] == (os.path.basename(segment_fullpath), record_start):
+            if segment_fullpath == self.bitcask.current_file_fullpath:
+                self.checkpoint = (self.bitcask.manifest_generation, self.bitcask.current_file, record_end)
+            else:
+                # this record triggered a rotation, so it was the last one in its segment
+                self.checkpoint = (self.bitcask.manifest_generation, self.bitcask.current_file, 0)
+                log_bytes += self._encode_log_checkpoint(self.checkpoint)
+
+        self._append_log(log_bytes)
+
+
+    def open(self, max_workers: int = 4) -> None:
+        """
+        Bring the index up to date with the BitCask: replay the log, then catch
+        up on the segments from the log's checkpoint onwards. If the log has
+        grown to more than twice the size of its compacted form (the current
+        entries plus one checkpoint), it's rewritten as that. Falls back to a
+        full rebuild when there is no log, or its checkpoint doesn't match the
+        BitCask (segment gone, offset past the end, or a newer generation than
+        the BitCask has, e.g. the directory was restored from an older snapshot).
+        """
+        if not os.path.exists(self.log_fullpath):
+            self.rebuild(max_workers)
+            return
+
+        self._load_log()
+        segments, active_segment_size = self._freeze_segments()
+        names = [os.path.basename(seg) for seg in segments]
+        if (self.checkpoint is None or self.checkpoint[0] > self.bitcask.manifest_generation
+                or self.checkpoint[1] not in names):
+            self.rebuild(max_workers)
+            return
+
+        first = names.index(self.checkpoint[1])
+        if self.checkpoint[2] > os.stat(segments[first]).st_size:
+            self.rebuild(max_workers)
+            return
+
+        # catch up, the first segment from the checkpoint offset, the rest whole
+        ranges = [(seg, 0, None) for seg in segments[first:]]
+        ranges[0] = (segments[first], self.checkpoint[2], None)
+        ranges[-1] = (ranges[-1][0], ranges[-1][1], active_segment_size)
+
+        log_bytes = b''
+        for segment_result in self._scan_ranges(ranges, max_workers):
+            for key, indexed_value in segment_result.items():
+                if self.forward.get(key) != indexed_value:
+                    self._apply(key, indexed_value)
+                    log_bytes += self._encode_log_entry(key, indexed_value)
+
+        loaded_checkpoint = self.checkpoint
+        self.checkpoint = (self.bitcask.manifest_generation, names[-1], active_segment_size)
+        if log_bytes or self.checkpoint != loaded_checkpoint:
+            self._append_log(log_bytes + self._encode_log_checkpoint(self.checkpoint))
+
+        compacted_size = (sum(len(self._encode_log_entry(key, indexed_value)) for key, indexed_value in self.forward.items())
+                          + len(self._encode_log_checkpoint(self.checkpoint)))
+        if os.stat(self.log_fullpath).st_size > 2 * compacted_size:
+            self._rewrite_log()
+
+
+    def rebuild(self, max_workers: int = 4) -> None:
+        """
+        Throw away the in-memory index and rebuild it from the BitCask segment
+        files, then rewrite the log from scratch (which also compacts it).
+
+        Each segment is scanned on its own worker thread and reduced to the
+        last thing written per key in that segment. The per-segment results
+        are then applied oldest to newest so later segments win. Threads
+        rather than processes, since extractors are often lambdas and those
+        can't be pickled, and most of the time goes to file reads anyway.
+        """
+        segments, active_segment_size = self._freeze_segments()
+        ranges = [(seg, 0, None) for seg in segments]
+        ranges[-1] = (segments[-1], 0, active_segment_size)
+
+        self.forward = {}
+        self.inverted = {}
+        for segment_result in self._scan_ranges(ranges, max_workers):
+            for key, indexed_value in segment_result.items():
+                self._apply(key, indexed_value)
+        self.checkpoint = (self.bitcask.manifest_generation, os.path.basename(segments[-1]), active_segment_size)
+        self._rewrite_log()
+
+
+    def _rewrite_log(self) -> None:
+        """
+        Replace the log with just the current entries and checkpoint. Written
+        to a temp file, fsync'd and renamed, so a crash leaves either the old
+        or the new log.
+        """
+        if self.bitcask.writable:
+            with open(self.log_fullpath + '.tmp', 'wb') as f:
+                for key, indexed_value in self.forward.items():
+                    f.write(self._encode_log_entry(key, indexed_value))
+                f.write(self._encode_log_checkpoint(self.checkpoint))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.log_fullpath + '.tmp', self.log_fullpath)
+
+
+    def _freeze_segments(self) -> tuple:
+        """
+        The BitCask's segments (oldest first) and the current size of the
+        active one, taken under its write lock so they agree with each other.
+        """
+        with self.bitcask._write_lock:
+            segments = self.bitcask.inactive_segments + [self.bitcask.current_file_fullpath]
+            return segments, os.stat(segments[-1]).st_size
+
+
+    def _scan_ranges(self, ranges: list, max_workers: int) -> list:
+        """
+        _scan_segment() every (segment, start, end) on a thread pool, results
+        come back in the same order as ranges.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda r: self._scan_segment(*r), ranges))
+
+
+    def _scan_segment(self, segment_fullpath: str, start_position: int = 0,
+                      end_position: Optional[int] = None) -> Dict[bytes, Optional[bytes]]:
+        """
+        Primary key -> indexed value (None if deleted or not indexable) for the
+        last record of every key in one segment (or the given part of it).
+        """
+        latest = {}
+        with open(segment_fullpath, 'rb') as f:
+            for _ts, key, value_position, value_size in self.bitcask._iter_segment_records(f, start_position, end_position):
+                # deleted, or too big to index (don't even read those)
+                if value_size is None or value_size > self.max_value_bytes:
+                    latest[key] = None
+                    continue
+                f.seek(value_position)
+                latest[key] = self.extract(f.read(value_size))
+        return latest
+
+
+    def _load_log(self) -> None:
+        """
+        Replay this index's log file into memory.
+        """
+        read_varint = self.bitcask._read_varint
+        with open(self.log_fullpath, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            while f.tell() < file_size:
+                # a partially written record at the end of the log is ignored
+                try:
+                    record_type = f.read(1)
+                    if record_type == b'@':
+                        generation = read_varint(f)
+                        segment = f.read(read_varint(f)).decode('utf-8')
+                        self.checkpoint = (generation, segment, read_varint(f))
+                        continue
+                    key_size = read_varint(f)
+                    value_size = read_varint(f)
+                except Exception:
+                    return
+                key = f.read(key_size)
+                indexed_value = f.read(value_size - 1) if value_size else None
+                if len(key) < key_size or (value_size and len(indexed_value) < value_size - 1):
+                    return
+
+                self._apply(key, indexed_value)
+
+
+    def _append_log(self, log_bytes: bytes) -> None:
+        if self.bitcask.writable and log_bytes:
+            with open(self.log_fullpath, 'ab') as f:
+                f.write(log_bytes)
+
+
+    def _apply(self, key: bytes, indexed_value: Optional[bytes]) -> None:
+        """
+        Point key at indexed_value in memory (None removes it from the index).
+        """
+        old_indexed_value = self.forward.pop(key, None)
+        if old_indexed_value is not None:
+            self.inverted[old_indexed_value].discard(key)
+            if not self.inverted[old_indexed_value]:
+                del self.inverted[old_indexed_value]
+
+        if indexed_value is not None:
+            self.forward[key] = indexed_value
+            self.inverted.setdefault(indexed_value, set()).add(key)
+
+
+    def _encode_log_entry(self, key: bytes, indexed_value: Optional[bytes]) -> bytes:
+        value_size = 0 if indexed_value is None else len(indexed_value) + 1
+        return (b'+' + self.bitcask._encode_varint(len(key)) + self.bitcask._encode_varint(value_size)
+                + key + (indexed_value or b''))
+
+
+    def _encode_log_checkpoint(self, checkpoint: tuple) -> bytes:
+        generation, segment, offset = checkpoint
+        return (b'@' + self.bitcask._encode_varint(generation) + self.bitcask._encode_varint(len(segment))
+                + segment.encode('utf-8') + self.bitcask._encode_varint(offset))
+
+
+
+class IndexedBitCask():
+    """
+    Wraps a BitCask and keeps any number of secondary indexes up to date as
+    values are put and deleted through it. Writes that go straight to the
+    wrapped BitCask (or put_stream, since extractors need the whole value)
+    are not seen by the indexes until the next time they're opened, which
+    catches up from the last checkpoint. query() double checks its results
+    against the stored values in the meantime.
+
+    Args:
+    - bitcask:      the BitCask to read from and write to
+    - max_workers:  number of threads used when rebuilding an index from the
+                    segment files
+    """
+
+    def __init__(self, bitcask: BitCask, max_workers: int = 4):
+        self.bitcask = bitcask
+        self.max_workers = max_workers
+        self.indexes = {}
+
+
+    def register_index(self, name: str, extractor: Callable[[bytes], Optional[bytes]],
+                       max_value_bytes: int = 2 ** 24) -> None:
+        """
+        Start maintaining a secondary index, see SecondaryIndex.open() for how
+        it's brought up to date. See SecondaryIndex for max_value_bytes.
+        """
+        if name in self.indexes:
+            raise Exception(f"An index named {name} is already registered.")
+
+        index = SecondaryIndex(self.bitcask, name, extractor, max_value_bytes)
+        index.open(self.max_workers)
+        self.indexes[name] = index
+
+
+    def rebuild_index(self, name: str) -> None:
+        self.indexes[name].rebuild(self.max_workers)
+
+
+    def put(self, key: bytes, value: bytes) -> None:
+        """
+        All the extractors run before anything is written, so an extractor that
+        raises leaves both the BitCask and the indexes untouched.
+        """
+        indexed_values = {name: index.extract(value) for name, index in self.indexes.items()}
+        location = self.bitcask.put(key, value)
+        for name, index in self.indexes.items():
+            index.update(key, indexed_values[name], location)
+
+
+    def delete(self, key: bytes) -> None:
+        location = self.bitcask.delete(key)
+        for index in self.indexes.values():
+            index.update(key, None, location)
+
+
+    def get(self, key: bytes) -> bytes:
+        return self.bitcask.get(key)
+
+
+    def query(self, index_name: str, indexed_value: bytes) -> Dict[bytes, bytes]:
+        """
+        Every primary key -> value whose extractor output equals indexed_value.
+        The primary lookups are done in one batch with BitCask.get_many().
+
+        The extractor is run again on every fetched value, and results that no
+        longer match are dropped. That covers writes made around the index
+        since it was opened. An extractor that raises on a value counts as
+        not matching.
+        """
+        index = self.indexes[index_name]
+        results = {}
+        for key, value in self.bitcask.get_many(index.lookup(indexed_value)).items():
+            try:
+                if index.extract(value) == indexed_value:
+                    results[key] = value
+            except Exception:
+                continue
+        return results
@@ -2,8 +2,11 @@
 import unittest
 from bitcask import BitCask
 import os
+import io
 import glob
 import re
+import tempfile
+from unittest import mock
 
 ONE_MB_IN_BYTES = int(2 ** 20)
 
@@ -11,8 +14,10 @@ def bc_delete(bc: BitCask, dir_path: str):
     """
     Cleans up after a test has been run.
     """
+    bc.close()
     file_pattern = dir_path + '/' + bc._FILE_SEG_ID_PREFIX + '*'
-    files_this_test = glob.glob(pathname=file_pattern)
+    files_this_test = glob.glob(pathname=file_pattern) + [dir_path + '/' + bc._MANIFEST_FILENAME,
+                                                          dir_path + '/' + bc._LOCK_FILENAME]
     for file in files_this_test:
     
         try: 
@@ -89,11 +94,9 @@ class TestBitCask(unittest.TestCase):
         file of "segment_9999999", in which case, we should roll this over
         to "segment_0000000". I want to make sure that happens gracefully.
 
-        TODO: come back and give this some more thought. Right now, I'm just
-        looking for the "max" filename that matches the segment file pattern.
-        Maybe instead, I should look for the most recently modified file
-        since filename doesn't necessarily indicate which file may be the
-        most recent.
+        The MANIFEST keeps the segments in the order they were written, so
+        reopening after the wrap doesn't depend on filenames anymore (see
+        test_manifest_survives_segment_id_wrap).
         """
 
         # set up and make sure it's cleared
@@ -136,7 +139,337 @@ class TestBitCask(unittest.TestCase):
         print('done.')
 
 
+    def test_varint_round_trip(self):
+        """
+        Key and value sizes are varints now, make sure they survive the trip
+        to and from bytes, including the values that used to be our limits.
+        """
+
+        dir_path = "test_four"
+        bc = BitCask(directory_path=dir_path)
+
+        for this_int in [0, 1, 127, 128, 300, 2 ** 16, 2 ** 24, 2 ** 40]:
+            with tempfile.TemporaryFile() as f:
+                f.write(bc._encode_varint(this_int))
+                f.seek(0)
+                self.assertEqual(bc._read_varint(f), this_int)
+
+        self.assertEqual(len(bc._encode_varint(127)), 1)
+        self.assertEqual(len(bc._encode_varint(128)), 2)
+
+        bc_delete(bc, dir_path)
+
+
+    def test_large_key_and_value(self):
+        """
+        Keys used to be capped at 64 KB and values at 16 MB. Neither limit
+        should exist anymore.
+        """
+
+        dir_path = "test_five"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+        bc = BitCask(directory_path=dir_path)
+
+        big_key = b'k' * (2 ** 16 + 1)
+        big_value = os.urandom(16 * ONE_MB_IN_BYTES + 1)
+        bc.put(big_key, big_value)
+        self.assertEqual(bc.get(big_key), big_value)
+
+        bc_delete(bc, dir_path)
+
+
+    def test_put_stream_and_get_stream(self):
+        """
+        Values written with put_stream() come back out of get_stream() in
+        chunks no bigger than _STREAM_CHUNK_BYTES, from both seekable and
+        non-seekable sources.
+        """
+
+        dir_path = "test_six"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+        bc = BitCask(directory_path=dir_path)
+
+        value = os.urandom(bc._STREAM_CHUNK_BYTES * 3 + 17)
+
+        # seekable source, size is worked out from the stream itself
+        bc.put_stream(b'seekable', io.BytesIO(value))
+        chunks = list(bc.get_stream(b'seekable'))
+        self.assertEqual(b''.join(chunks), value)
+        self.assertTrue(all(len(c) <= bc._STREAM_CHUNK_BYTES for c in chunks))
+
+        # missing keys fail on the call, not on the first chunk
+        with self.assertRaises(KeyError):
+            bc.get_stream(b'missing')
+
+        # non-seekable source, gets spooled to a temp file first
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(write_fd, 'wb') as w:
+            w.write(value[:1000])
+        with os.fdopen(read_fd, 'rb') as r:
+            bc.put_stream(b'pipe', r)
+        self.assertEqual(bc.get(b'pipe'), value[:1000])
+
+        # a stream that is shorter than it claims should not leave a partial record
+        size_before = os.stat(bc.current_file_fullpath).st_size
+        with self.assertRaises(Exception):
+            bc.put_stream(b'short', io.BytesIO(b'abc'), value_size=10)
+        self.assertEqual(os.stat(bc.current_file_fullpath).st_size, size_before)
+
+        # same for a source that raises part way through
+        class FailingReader(io.BytesIO):
+            reads = 0
+            def read(self, *args):
+                self.reads += 1
+                if self.reads == 3:
+                    raise IOError("source went away")
+                return super().read(*args)
+
+        with self.assertRaises(IOError):
+            bc.put_stream(b'failing', FailingReader(value))
+        self.assertEqual(os.stat(bc.current_file_fullpath).st_size, size_before)
+
+        bc.put(b'c', b'written after the failure')
+        bc.close()
+        bc = BitCask(directory_path=dir_path)
+        self.assertEqual(bc.get(b'c'), b'written after the failure')
+        with self.assertRaises(KeyError):
+            bc.get(b'failing')
+
+        bc_delete(bc, dir_path)
+
+
+    def test_reopen_rebuilds_keydir(self):
+        """
+        Opening an existing directory should be able to read back what an
+        earlier instance wrote, across segment files.
+        """
 
+        dir_path = "test_seven"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+        bc = BitCask(directory_path=dir_path)
+
+        while bc.current_file_number < 2:
+            bc.put(b'key1', b'value1 first value')
+            bc.put(b'key2', b'value2 first value')
+        bc.put(b'key1', b'latest value1')
+
+        bc2 = BitCask(directory_path=dir_path, write=False)
+        self.assertEqual(bc2.get(b'key1'), b'latest value1')
+        self.assertEqual(bc2.get(b'key2'), b'value2 first value')
+        self.assertEqual(bc2.current_file, bc.current_file)
+        self.assertEqual(bc2.inactive_segments, bc.inactive_segments)
+
+        bc_delete(bc, dir_path)
 
 
+    def test_snapshot(self):
+        """
+        A snapshot should contain everything written before it was taken and
+        nothing written after. Inactive segments are hard links, not copies.
+        """
+
+        dir_path = "test_eight"
+        snapshot_path = "test_eight_snapshot"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+        bc_delete(bc, snapshot_path)
+        bc = BitCask(directory_path=dir_path)
+
+        while bc.current_file_number < 2:
+            bc.put(b'key1', b'value1 first value')
+            bc.put(b'key2', b'value2 first value')
+        bc.put(b'key1', b'before snapshot')
 
+        with self.assertRaises(Exception):
+            BitCask(directory_path=dir_path, write=False).snapshot(snapshot_path)
+        self.assertFalse(os.path.exists(snapshot_path))
+
+        bc.snapshot(snapshot_path)
+
+        bc.put(b'key1', b'after snapshot')
+        bc.put(b'key3', b'after snapshot')
+
+        snap = BitCask(directory_path=snapshot_path)
+        self.assertEqual(snap.get(b'key1'), b'before snapshot')
+        self.assertEqual(snap.get(b'key2'), b'value2 first value')
+        self.assertEqual(snap.keydir[snap._hashmod_this_key(b'key3')], -1)
+        self.assertEqual(bc.get(b'key1'), b'after snapshot')
+
+        for segment_fullpath in bc.inactive_segments:
+            snap_fullpath = snapshot_path + '/' + os.path.basename(segment_fullpath)
+            self.assertEqual(os.stat(segment_fullpath).st_ino, os.stat(snap_fullpath).st_ino)
+        self.assertNotEqual(os.stat(bc.current_file_fullpath).st_ino,
+                            os.stat(snap.current_file_fullpath).st_ino)
+
+        bc_delete(bc, dir_path)
+        bc_delete(snap, snapshot_path)
+
+
+    def test_manifest_survives_segment_id_wrap(self):
+        """
+        After the segment ids wrap around to zero, reopening the directory
+        should still pick the newest segment as the active one, without
+        listing the directory to find out.
+        """
+
+        dir_path = "test_nine"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+
+        os.makedirs(dir_path)
+        with open(dir_path + '/segment_9999998', 'wb') as f:
+            f.write(b'')
+
+        bc = BitCask(directory_path=dir_path)
+        generation_before = bc.manifest_generation
+        while bc.current_file_number != 1:
+            bc.put(b'key1', b'value1 first value')
+        bc.put(b'key1', b'latest value1')
+        self.assertEqual(bc.manifest_generation, generation_before + 3)
+        bc.close()
+
+        generation_before = bc.manifest_generation
+        with mock.patch('os.listdir', side_effect=AssertionError("listdir should not be called")):
+            bc = BitCask(directory_path=dir_path)
+        self.assertEqual(bc.manifest_generation, generation_before + 1)
+
+        self.assertEqual(bc.current_file, 'segment_0000001')
+        self.assertEqual(bc.inactive_segments, [dir_path + '/segment_9999998',
+                                                dir_path + '/segment_9999999',
+                                                dir_path + '/segment_0000000'])
+        self.assertEqual(bc.get(b'key1'), b'latest value1')
+
+        bc_delete(bc, dir_path)
+
+
+    def test_single_writer_lock(self):
+        """
+        A second writer on the same directory is refused until the first one
+        closes, readers are always allowed.
+        """
+
+        dir_path = "test_ten"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+        bc = BitCask(directory_path=dir_path)
+        bc.put(b'key1', b'value1 first value')
+
+        with self.assertRaises(Exception):
+            BitCask(directory_path=dir_path)
+
+        reader = BitCask(directory_path=dir_path, write=False)
+        self.assertEqual(reader.get(b'key1'), b'value1 first value')
+
+        bc.close()
+        bc2 = BitCask(directory_path=dir_path)
+        self.assertEqual(bc2.get(b'key1'), b'value1 first value')
+
+        bc_delete(bc2, dir_path)
+
+
+    def test_delete_and_get_many(self):
+        """
+        Deleted keys raise KeyError, stay deleted after reopening, and are
+        left out of get_many().
+        """
+
+        dir_path = "test_eleven"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+        bc = BitCask(directory_path=dir_path)
+
+        bc.put(b'key1', b'value1 first value')
+        bc.put(b'key2', b'value2 first value')
+        bc.put(b'key3', b'value3 first value')
+        bc.delete(b'key2')
+
+        with self.assertRaises(KeyError):
+            bc.get(b'key2')
+        self.assertEqual(bc.get_many([b'key1', b'key2', b'key3', b'nope']),
+                         {b'key1': b'value1 first value', b'key3': b'value3 first value'})
+
+        # values that look like the old magic tombstone, or are empty, are just values
+        bc.put(b'key4', b'bitcask_tombstone')
+        bc.put(b'key5', b'')
+
+        bc.close()
+        bc = BitCask(directory_path=dir_path)
+        with self.assertRaises(KeyError):
+            bc.get(b'key2')
+        self.assertEqual(bc.get(b'key3'), b'value3 first value')
+        self.assertEqual(bc.get(b'key4'), b'bitcask_tombstone')
+        self.assertEqual(bc.get(b'key5'), b'')
+
+        bc_delete(bc, dir_path)
+
+
+    def test_wrap_onto_segment_in_use_rejects_write(self):
+        """
+        If the segment id would wrap onto a segment that's still in use, the
+        put that would trigger that rotation fails without writing anything,
+        and keeps failing without corrupting the segment list.
+        """
+
+        dir_path = "test_twelve"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+
+        os.makedirs(dir_path)
+        for segment in ['segment_0000000', 'segment_9999999']:
+            with open(dir_path + '/' + segment, 'wb') as f:
+                f.write(b'')
+
+        bc = BitCask(directory_path=dir_path)
+        self.assertEqual(bc.current_file, 'segment_9999999')
+        bc.put(b'key1', b'x' * (ONE_MB_IN_BYTES + 1))
+
+        with open(dir_path + '/' + bc._MANIFEST_FILENAME) as f:
+            manifest_before = f.read()
+        sizes_before = {seg: os.stat(dir_path + '/' + seg).st_size for seg in ['segment_0000000', 'segment_9999999']}
+
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                bc.put(b'key2', b'value2 first value')
+
+        self.assertEqual(bc.current_file, 'segment_9999999')
+        self.assertEqual(bc.inactive_segments, [dir_path + '/segment_0000000'])
+        self.assertEqual(bc.keydir[bc._hashmod_this_key(b'key2')], -1)
+        self.assertEqual({seg: os.stat(dir_path + '/' + seg).st_size for seg in sizes_before}, sizes_before)
+        with open(dir_path + '/' + bc._MANIFEST_FILENAME) as f:
+            self.assertEqual(f.read(), manifest_before)
+
+        bc_delete(bc, dir_path)
+
+
+    def test_torn_tail_is_truncated_on_writable_open(self):
+        """
+        A partially written record at the end of the active segment must not
+        swallow writes made after reopening.
+        """
+
+        dir_path = "test_thirteen"
+        bc = BitCask(directory_path=dir_path)
+        bc_delete(bc, dir_path)
+        bc = BitCask(directory_path=dir_path)
+        bc.put(b'key1', b'value1 first value')
+        bc.close()
+
+        # half of a record: timestamp, sizes claiming a 100 byte value, key, 3 value bytes
+        with open(bc.current_file_fullpath, 'ab') as f:
+            f.write(b'2026-01-01 00:00:00.000000' + bc._encode_varint(4) + bc._encode_varint(101) + b'torn' + b'abc')
+
+        bc = BitCask(directory_path=dir_path)
+        bc.put(b'c', b'hello')
+        self.assertEqual(bc.get(b'c'), b'hello')
+        bc.close()
+
+        bc = BitCask(directory_path=dir_path)
+        self.assertEqual(bc.get(b'c'), b'hello')
+        self.assertEqual(bc.get(b'key1'), b'value1 first value')
+        with self.assertRaises(KeyError):
+            bc.get(b'torn')
+
+        bc_delete(bc, dir_path)
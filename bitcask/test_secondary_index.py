@@ -0,0 +1,256 @@
+
+import unittest
+from bitcask import BitCask
+from secondary_index import IndexedBitCask
+import json
+import os
+import shutil
+
+
+def user_id_of(value: bytes):
+    return json.loads(value).get('user_id', '').encode() or None
+
+
+def ibc_delete(ibc: IndexedBitCask, dir_path: str):
+    """
+    Cleans up after a test has been run.
+    """
+    ibc.bitcask.close()
+    shutil.rmtree(dir_path, ignore_errors=True)
+
+
+class TestSecondaryIndex(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree("test_index", ignore_errors=True)
+
+
+    def test_query_follows_put_and_delete(self):
+
+        dir_path = "test_index"
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+
+        ibc.put(b'order1', b'{"user_id": "nelson", "total": 1}')
+        ibc.put(b'order2', b'{"user_id": "ari", "total": 2}')
+        ibc.put(b'order3', b'{"user_id": "nelson", "total": 3}')
+        ibc.put(b'order4', b'{"total": 4}')
+
+        self.assertEqual(set(ibc.query('user_id', b'nelson')), {b'order1', b'order3'})
+        self.assertEqual(ibc.query('user_id', b'ari'), {b'order2': b'{"user_id": "ari", "total": 2}'})
+
+        # moving a record to another user and deleting one
+        ibc.put(b'order1', b'{"user_id": "ari", "total": 1}')
+        ibc.delete(b'order3')
+
+        self.assertEqual(ibc.query('user_id', b'nelson'), {})
+        self.assertEqual(set(ibc.query('user_id', b'ari')), {b'order1', b'order2'})
+        self.assertEqual(ibc.query('user_id', b'nobody'), {})
+
+        ibc_delete(ibc, dir_path)
+
+
+    def test_index_reloads_from_log(self):
+
+        dir_path = "test_index"
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        ibc.put(b'order1', b'{"user_id": "nelson"}')
+        ibc.put(b'order2', b'{"user_id": "ari"}')
+        ibc.put(b'order2', b'{"user_id": "nelson"}')
+        ibc.delete(b'order1')
+        ibc.bitcask.close()
+
+        # the first reopen catches up on the active segment and logs a checkpoint
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        ibc.bitcask.close()
+
+        # an extractor that blows up proves the segments aren't being rescanned
+        def not_called(value):
+            raise AssertionError("should have replayed the index log")
+
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', not_called)
+        ibc.indexes['user_id'].extractor = user_id_of
+        self.assertEqual(ibc.query('user_id', b'nelson'), {b'order2': b'{"user_id": "nelson"}'})
+        self.assertEqual(ibc.query('user_id', b'ari'), {})
+
+        ibc_delete(ibc, dir_path)
+
+
+    def test_parallel_rebuild_from_segments(self):
+        """
+        An index registered on a BitCask that already has data (spread over
+        several segments) gets built from the segment files.
+        """
+
+        dir_path = "test_index"
+        bc = BitCask(directory_path=dir_path)
+        while bc.current_file_number < 3:
+            for i in range(100):
+                bc.put(b'order' + str(i).encode(),
+                       json.dumps({'user_id': 'user' + str(i % 7), 'pad': 'x' * 1000}).encode())
+        bc.put(b'order1', json.dumps({'user_id': 'user0'}).encode())
+        bc.delete(b'order2')
+
+        ibc = IndexedBitCask(bc, max_workers=4)
+        ibc.register_index('user_id', user_id_of)
+
+        expected = {b'order' + str(i).encode() for i in range(100) if i % 7 == 0}
+        self.assertEqual(set(ibc.query('user_id', b'user0')), expected | {b'order1'})
+        self.assertNotIn(b'order1', ibc.query('user_id', b'user1'))
+        self.assertNotIn(b'order2', ibc.query('user_id', b'user2'))
+        self.assertTrue(os.path.exists(dir_path + '/index_user_id.log'))
+
+        ibc_delete(ibc, dir_path)
+
+
+    def test_bad_index_name(self):
+
+        dir_path = "test_index"
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        with self.assertRaises(Exception):
+            ibc.register_index('../escape', user_id_of)
+
+        ibc_delete(ibc, dir_path)
+
+
+    def test_extractor_error_writes_nothing(self):
+
+        dir_path = "test_index"
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        ibc.put(b'order1', b'{"user_id": "nelson"}')
+
+        with self.assertRaises(json.JSONDecodeError):
+            ibc.put(b'order1', b'not json')
+
+        self.assertEqual(ibc.get(b'order1'), b'{"user_id": "nelson"}')
+        self.assertEqual(ibc.query('user_id', b'nelson'), {b'order1': b'{"user_id": "nelson"}'})
+
+        ibc_delete(ibc, dir_path)
+
+
+    def test_values_over_size_limit_are_not_indexed(self):
+
+        dir_path = "test_index"
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of, max_value_bytes=100)
+
+        ibc.put(b'small', b'{"user_id": "nelson"}')
+        ibc.put(b'big', json.dumps({'user_id': 'nelson', 'pad': 'x' * 200}).encode())
+        self.assertEqual(set(ibc.query('user_id', b'nelson')), {b'small'})
+
+        # a rebuild agrees with the put path and never reads the big value
+        def refuse_big(value):
+            self.assertLessEqual(len(value), 100)
+            return user_id_of(value)
+
+        ibc.indexes['user_id'].extractor = refuse_big
+        ibc.rebuild_index('user_id')
+        self.assertEqual(set(ibc.query('user_id', b'nelson')), {b'small'})
+
+        ibc_delete(ibc, dir_path)
+
+
+    def test_writes_around_the_index_are_caught_up_on(self):
+        """
+        A write straight to the BitCask is filtered out of query() right away,
+        and picked up from the checkpoint the next time the index is opened.
+        Only the segment data after the last logged checkpoint gets scanned
+        (here that's the whole active segment, checkpoints within the active
+        segment only live in memory).
+        """
+
+        dir_path = "test_index"
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        ibc.put(b'order1', b'{"user_id": "a"}')
+        ibc.put(b'order2', b'{"user_id": "a"}')
+        ibc.bitcask.put(b'order2', b'{"user_id": "b"}')
+        ibc.put(b'order3', b'{"user_id": "a"}')
+
+        self.assertEqual(set(ibc.query('user_id', b'a')), {b'order1', b'order3'})
+        ibc.bitcask.close()
+
+        scanned = []
+        def counting_extractor(value):
+            scanned.append(value)
+            return user_id_of(value)
+
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', counting_extractor)
+        self.assertEqual(scanned, [b'{"user_id": "a"}', b'{"user_id": "a"}',
+                                   b'{"user_id": "b"}', b'{"user_id": "a"}'])
+        self.assertEqual(set(ibc.query('user_id', b'a')), {b'order1', b'order3'})
+        self.assertEqual(ibc.query('user_id', b'b'), {b'order2': b'{"user_id": "b"}'})
+        ibc.bitcask.close()
+
+        # once caught up, the next open has nothing left to scan
+        scanned.clear()
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', counting_extractor)
+        self.assertEqual(scanned, [])
+        self.assertEqual(ibc.query('user_id', b'b'), {b'order2': b'{"user_id": "b"}'})
+
+        ibc_delete(ibc, dir_path)
+
+
+    def test_checkpoint_mismatch_rebuilds(self):
+        """
+        If the checkpoint points at a segment the BitCask no longer has, the
+        index is rebuilt from scratch instead of trusting the log.
+        """
+
+        dir_path = "test_index"
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        ibc.put(b'order1', b'{"user_id": "a"}')
+        ibc.bitcask.close()
+
+        index = ibc.indexes['user_id']
+        with open(index.log_fullpath, 'ab') as f:
+            f.write(index._encode_log_checkpoint((0, 'segment_0000042', 0)))
+
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        self.assertEqual(ibc.indexes['user_id'].checkpoint[1], 'segment_0000000')
+        self.assertEqual(set(ibc.query('user_id', b'a')), {b'order1'})
+
+        ibc_delete(ibc, dir_path)
+
+
+    def test_log_size_stays_bounded(self):
+        """
+        Rewriting an unchanged indexed value doesn't grow the log, and a log
+        full of superseded entries gets compacted on the next open.
+        """
+
+        dir_path = "test_index"
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        log_fullpath = ibc.indexes['user_id'].log_fullpath
+
+        for _ in range(10000):
+            ibc.put(b'order1', b'{"user_id": "a"}')
+        self.assertLess(os.path.getsize(log_fullpath), 200)
+
+        for i in range(2000):
+            ibc.put(b'order1', b'{"user_id": "a"}' if i % 2 else b'{"user_id": "b"}')
+        self.assertGreater(os.path.getsize(log_fullpath), 10000)
+        ibc.bitcask.close()
+
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        self.assertLess(os.path.getsize(log_fullpath), 200)
+        self.assertEqual(ibc.query('user_id', b'a'), {b'order1': b'{"user_id": "a"}'})
+        ibc.bitcask.close()
+
+        # and the compacted log replays to the same thing
+        ibc = IndexedBitCask(BitCask(directory_path=dir_path))
+        ibc.register_index('user_id', user_id_of)
+        self.assertEqual(ibc.query('user_id', b'a'), {b'order1': b'{"user_id": "a"}'})
+        self.assertEqual(ibc.query('user_id', b'b'), {})
+
+        ibc_delete(ibc, dir_path)